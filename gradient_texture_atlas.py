@@ -1,81 +1,101 @@
 import os
-import glob
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image, ImageDraw
-import random
 import math
+from functools import lru_cache, partial
+import numpy as np
 
 def hex_to_rgb(hex_color):
     """Convert hex color to RGB tuple"""
-    return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+    return tuple(bytes.fromhex(hex_color))
 
-def rgb_distance(color1, color2):
-    """Calculate Euclidean distance between two RGB colors"""
-    return math.sqrt(sum((a - b) ** 2 for a, b in zip(color1, color2)))
+def build_neighbor_order(colors):
+    """For every color, list the indices of all other colors from nearest to farthest"""
+    palette = np.asarray(colors, dtype=np.int32)
 
-def find_neighbors(target_color, colors, max_neighbors=3, min_distance=2):
-    """Find 1-3 nearest neighbor colors with minimum distance spacing"""
-    distances = [(rgb_distance(target_color, color), color) for color in colors if color != target_color]
-    distances.sort()
+    # Squared distances sort the same as Euclidean ones, so skip the sqrt
+    diff = palette[:, None, :] - palette[None, :, :]
+    distances = (diff * diff).sum(axis=-1)
 
-    # Select neighbors with spacing - skip closer ones to get more variety
-    selected = []
-    start_index = min_distance  # Start from at least 2-4 positions away
-    for i in range(start_index, min(start_index + max_neighbors, len(distances))):
-        if i < len(distances):
-            selected.append(distances[i][1])
+    # Sort each row by distance, breaking ties by color value
+    r, g, b = (np.broadcast_to(palette[:, i], distances.shape) for i in range(3))
+    order = np.lexsort((b, g, r, distances), axis=-1)
+
+    # Identical colors (including the color itself) sort first - drop them
+    num_same = (distances == 0).sum(axis=1)
+    return [row[n:] for row, n in zip(order, num_same)]
 
-    return selected
+def find_neighbors(neighbor_order, colors, target_index, max_neighbors=3, min_distance=2):
+    """Find 1-3 nearest neighbor colors with minimum distance spacing"""
+    # Select neighbors with spacing - skip closer ones to get more variety
+    # Start from at least 2-4 positions away
+    nearest = neighbor_order[target_index][min_distance:min_distance + max_neighbors]
+    return [colors[i] for i in nearest]
 
 def get_lightest_darkest(colors):
     """Find the lightest and darkest colors based on luminance"""
-    def luminance(color):
-        r, g, b = color
-        return 0.299 * r + 0.587 * g + 0.114 * b
+    # Rec. 601 weights scaled by 1000 - same ordering, integer math only
+    luminance = np.asarray(colors, dtype=np.int32) @ np.array([299, 587, 114], dtype=np.int32)
+
+    # On ties, keep the first darkest and the last lightest color like a stable sort
+    darkest = colors[luminance.argmin()]
+    lightest = colors[len(colors) - 1 - luminance[::-1].argmax()]
+    return darkest, lightest
+
+@lru_cache(maxsize=16)
+def _make_gradient_kernel(num_colors, length):
+    """Build a blend function specialized for one color count and gradient length"""
+    if num_colors == 1:
+        # Solid color
+        def solid(palettes):
+            return np.broadcast_to(palettes.astype(np.uint8), (len(palettes), length, 3))
+        return solid
 
-    sorted_colors = sorted(colors, key=luminance)
-    return sorted_colors[0], sorted_colors[-1]  # darkest, lightest
+    # Position in gradient (0.0 to 1.0)
+    pos = np.arange(length) / (length - 1) if length > 1 else np.zeros(1)
 
-def create_gradient(colors, width, height, vertical=True):
-    """Create a gradient image from a list of colors"""
-    img = Image.new('RGB', (width, height))
-    pixels = []
+    # Find which segment of the gradient each position is in
+    segment_size = 1.0 / (num_colors - 1)
+    segment = np.minimum((pos / segment_size).astype(np.intp), num_colors - 2)
 
-    if len(colors) == 1:
-        # Solid color
-        pixels = [colors[0]] * (width * height)
-    else:
-        # Multi-color gradient
-        for y in range(height):
-            for x in range(width):
-                # Calculate position in gradient (0.0 to 1.0)
-                if vertical:
-                    pos = y / (height - 1) if height > 1 else 0
-                else:
-                    pos = x / (width - 1) if width > 1 else 0
+    # Local position within the segment (0.0 to 1.0)
+    local_pos = (pos - segment * segment_size)[:, None] / segment_size
+    next_segment = segment + 1
 
-                # Find which segment of the gradient we're in
-                segment_size = 1.0 / (len(colors) - 1)
-                segment = int(pos / segment_size)
-                segment = min(segment, len(colors) - 2)
+    def blend(palettes):
+        # Interpolate between the two colors
+        color1 = palettes[:, segment]
+        color2 = palettes[:, next_segment]
+        return (color1 + (color2 - color1) * local_pos).astype(np.uint8)
 
-                # Local position within the segment (0.0 to 1.0)
-                local_pos = (pos - segment * segment_size) / segment_size
+    return blend
 
-                # Interpolate between the two colors
-                color1 = colors[segment]
-                color2 = colors[segment + 1]
+def create_gradient_arrays(color_lists, width, height, vertical=True):
+    """Create equally sized (height, width, 3) gradient arrays from several lists of colors at once"""
+    length = height if vertical else width
+    lines = np.empty((len(color_lists), length, 3), dtype=np.uint8)
 
-                r = int(color1[0] + (color2[0] - color1[0]) * local_pos)
-                g = int(color1[1] + (color2[1] - color1[1]) * local_pos)
-                b = int(color1[2] + (color2[2] - color1[2]) * local_pos)
+    # Gradients with the same number of colors share their geometry, blend each group in one go
+    groups = {}
+    for i, colors in enumerate(color_lists):
+        groups.setdefault(len(colors), []).append(i)
 
-                pixels.append((r, g, b))
+    for num_colors, indices in groups.items():
+        palettes = np.asarray([color_lists[i] for i in indices], dtype=np.float64)
+        lines[indices] = _make_gradient_kernel(num_colors, length)(palettes)
 
-    img.putdata(pixels)
-    return img
+    # Broadcast each line across the other axis - read-only views, nothing is copied yet
+    if vertical:
+        return [np.broadcast_to(line[:, None, :], (height, width, 3)) for line in lines]
+    return [np.broadcast_to(line[None, :, :], (height, width, 3)) for line in lines]
 
-def process_hex_file(hex_file_path):
+def process_hex_file(hex_file_path, seed=None, compress_level=1):
     """Process a single .hex file and create texture atlas"""
+    print(f"Processing {hex_file_path}...")
+
+    # Fresh OS entropy by default so every run differs, pass a seed to reproduce an atlas
+    rng = np.random.default_rng(seed)
+
     # Read hex colors
     with open(hex_file_path, 'r') as f:
         hex_colors = [line.strip() for line in f if line.strip()]
@@ -87,8 +107,11 @@ def process_hex_file(hex_file_path):
         print(f"No valid colors found in {hex_file_path}")
         return
 
-    # Create 2048x2048 canvas
-    canvas = Image.new('RGB', (2048, 2048), (255, 255, 255))
+    # Rank every color's neighbors once, all lookups below reuse it
+    neighbor_order = build_neighbor_order(rgb_colors)
+
+    # Create 2048x2048 canvas - everything is drawn straight into this array
+    canvas = np.full((2048, 2048, 3), 255, dtype=np.uint8)
 
     # MAIN gradient width (narrower than before)
     main_gradient_width = 100
@@ -130,82 +153,107 @@ def process_hex_file(hex_file_path):
     # Calculate square height
     square_height = min(square_width, gradient_start_y // grid_rows)
 
-    # Calculate actual grid dimensions
-    grid_height = grid_rows * square_height
+    # Column edges - the first columns get an extra pixel to fill the row exactly
+    column_widths = np.full(grid_cols, square_width)
+    column_widths[:remaining_width_per_row] += 1
+    column_edges = np.concatenate(([0], np.cumsum(column_widths)))
 
     # Draw color grid (squares) with perfect alignment
     for i, color in enumerate(rgb_colors):
         row = i // grid_cols
         col = i % grid_cols
 
-        # Calculate position
-        x = col * square_width
         y = row * square_height
-
-        # Calculate width for this square - add extra pixel to first squares if needed
-        current_square_width = square_width
-        if col < remaining_width_per_row:
-            current_square_width += 1
-            # Adjust x position for squares that come after the wider ones
-            x += col
-        else:
-            # Adjust x position for squares that come after the wider ones
-            x += remaining_width_per_row
-
-        # Create color square
-        square = Image.new('RGB', (current_square_width, square_height), color)
-        canvas.paste(square, (x, y))
+        canvas[y:y + square_height, column_edges[col]:column_edges[col + 1]] = color
 
     # MAIN gradient extends from gradients to the very right edge
     actual_main_gradient_width = 2048 - total_gradient_width
-    main_gradient = create_gradient(rgb_colors, actual_main_gradient_width, 2048, vertical=True)
-    canvas.paste(main_gradient, (total_gradient_width, 0))
+    main_gradient = create_gradient_arrays([rgb_colors], actual_main_gradient_width, 2048, vertical=True)[0]
+    canvas[:, total_gradient_width:] = main_gradient
+
+    # All bottom gradients have the same size - collect their colors and build them together
+    bottom_colors = []
+    bottom_positions = []
 
     # First gradient: lightest to darkest
     darkest, lightest = get_lightest_darkest(rgb_colors)
-    first_gradient = create_gradient([lightest, darkest], gradient_width, gradient_height, vertical=True)
-    canvas.paste(first_gradient, (0, gradient_start_y))
+    bottom_colors.append([lightest, darkest])
+    bottom_positions.append((0, gradient_start_y))
+
+    # Draw all random choices for the bottom rows up front
+    start_indices = rng.integers(0, num_colors, size=num_gradients)
+    max_neighbors = rng.integers(1, 4, size=num_gradients)
+    min_distances = rng.integers(2, 5, size=num_gradients)
+    neighbor_counts = rng.integers(1, 3, size=num_gradients)
+    random_color_counts = rng.integers(2, 4, size=num_gradients + 1)
 
     # First row of bottom gradients: neighboring colors with more spacing
     for i in range(num_gradients):
-        # Pick a random starting color
-        start_color = random.choice(rgb_colors)
-        neighbors = find_neighbors(start_color, rgb_colors, random.randint(1, 3), min_distance=random.randint(2, 4))
+        # Random starting color
+        start_index = start_indices[i]
+        start_color = rgb_colors[start_index]
+        neighbors = find_neighbors(neighbor_order, rgb_colors, start_index, max_neighbors[i], min_distance=min_distances[i])
 
         if neighbors:
-            gradient_colors = [start_color] + neighbors[:random.randint(1, min(2, len(neighbors)))]
+            gradient_colors = [start_color] + neighbors[:min(neighbor_counts[i], len(neighbors))]
         else:
             gradient_colors = [start_color]
 
-        gradient = create_gradient(gradient_colors, gradient_width, gradient_height, vertical=True)
-        canvas.paste(gradient, ((i + 1) * gradient_width, gradient_start_y))
+        bottom_colors.append(gradient_colors)
+        bottom_positions.append(((i + 1) * gradient_width, gradient_start_y))
 
     # Second row of bottom gradients: random colors
     for i in range(num_gradients + 1):  # Include all positions
         # 2-3 random colors
-        num_random_colors = random.randint(2, 3)
-        gradient_colors = random.sample(rgb_colors, min(num_random_colors, len(rgb_colors)))
+        picks = rng.choice(num_colors, size=min(random_color_counts[i], num_colors), replace=False)
+        gradient_colors = [rgb_colors[j] for j in picks]
+
+        bottom_colors.append(gradient_colors)
+        bottom_positions.append((i * gradient_width, gradient_start_y + gradient_height))
 
-        gradient = create_gradient(gradient_colors, gradient_width, gradient_height, vertical=True)
-        canvas.paste(gradient, (i * gradient_width, gradient_start_y + gradient_height))
+    gradients = create_gradient_arrays(bottom_colors, gradient_width, gradient_height, vertical=True)
+    for gradient, (x, y) in zip(gradients, bottom_positions):
+        canvas[y:y + gradient_height, x:x + gradient_width] = gradient
 
     # Save the image
     base_name = os.path.splitext(os.path.basename(hex_file_path))[0]
     output_path = f"{base_name}-cta.png"
-    canvas.save(output_path)
+    Image.fromarray(canvas, 'RGB').save(output_path, format='PNG', compress_level=compress_level)
     print(f"Created texture atlas: {output_path}")
 
+def get_png_compress_level():
+    """Read the PNG compression level (0-9) from GCTAM_PNG_LEVEL, defaulting to 1"""
+    # Lower saves faster, higher gives smaller files
+    value = os.environ.get("GCTAM_PNG_LEVEL", "").strip() or "1"
+    try:
+        level = int(value)
+    except ValueError:
+        level = -1
+
+    if not 0 <= level <= 9:
+        print(f"Invalid GCTAM_PNG_LEVEL '{value}', expected a number from 0 to 9 - using 1")
+        return 1
+    return level
+
 def main():
     """Process all .hex files in the current directory"""
-    hex_files = glob.glob("*.hex")
+    # Like glob("*.hex"): skip hidden files, case-insensitive where the OS is
+    with os.scandir('.') as entries:
+        hex_files = [entry.name for entry in entries
+                     if entry.is_file() and not entry.name.startswith('.')
+                     and os.path.normcase(entry.name).endswith('.hex')]
 
     if not hex_files:
         print("No .hex files found in the current directory")
         return
 
-    for hex_file in hex_files:
-        print(f"Processing {hex_file}...")
-        process_hex_file(hex_file)
+    compress_level = get_png_compress_level()
+
+    # Files are independent, so spread them over the CPU cores - but no more workers than files.
+    # With at least one file per core keep the default pool size, which Windows caps at 61 workers
+    max_workers = len(hex_files) if len(hex_files) < (os.cpu_count() or 1) else None
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(partial(process_hex_file, compress_level=compress_level), hex_files))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file